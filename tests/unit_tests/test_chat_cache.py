@@ -0,0 +1,73 @@
+import asyncio
+import os
+import sys
+import tempfile
+from typing import Optional
+
+# The function-calling example needs the ollama client (and its pydantic
+# response types); skip when it is not installed.
+try:
+    import ollama  # noqa: F401
+    from pydantic import BaseModel
+    deps_available = True
+except ImportError:
+    deps_available = False
+
+if deps_available:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    "..", "..", "agent_behavior_cloning"))
+    import llm_with_function_calling as fc
+
+    # Minimal stand-ins for ollama>=0.4's pydantic response objects.
+    class Message(BaseModel):
+        role: str = "assistant"
+        content: str = "cached hello"
+        tool_calls: Optional[list] = None  # ollama leaves this None when no tools fire
+
+    class ChatResponse(BaseModel):
+        message: Message = Message()
+
+    class FakeClient:
+        def __init__(self):
+            self.calls = 0
+
+        async def chat(self, **kwargs):
+            self.calls += 1
+            return ChatResponse()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fc.CACHE_PATH = os.path.join(tmpdir, "chat_cache.sqlite")
+        fc._cache_db = None
+        fc._mem_cache = {}
+
+        client = FakeClient()
+        messages = [{"role": "user", "content": "hello"}]
+        options = {"temperature": 0.0}
+
+        # Miss: the pydantic response is normalized and stored as a plain dict.
+        r1 = asyncio.run(fc._chat_cached(client, "m", messages, None, options))
+        assert client.calls == 1
+        assert isinstance(r1, dict)
+        assert r1["message"]["content"] == "cached hello"
+
+        # Exact repeat is served from the in-memory cache.
+        r2 = asyncio.run(fc._chat_cached(client, "m", messages, None, options))
+        assert client.calls == 1
+        assert r2 == r1
+
+        # A fresh process (simulated by clearing in-memory state) round-trips
+        # through the SQLite table.
+        fc._mem_cache = {}
+        fc._cache_db = None
+        r3 = asyncio.run(fc._chat_cached(client, "m", messages, None, options))
+        assert client.calls == 1
+        assert r3 == r1
+
+        # A conversation containing pydantic Message objects (the follow-up
+        # call after a tool run) must hash cleanly as well.
+        followup = messages + [r1["message"],
+                               Message(role="tool", content="result", tool_calls=None)]
+        r4 = asyncio.run(fc._chat_cached(client, "m", followup, None, options))
+        assert client.calls == 2
+
+        print("chat cache round trip ok")
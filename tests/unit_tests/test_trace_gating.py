@@ -0,0 +1,71 @@
+import os
+import sys
+import tempfile
+
+# The function-calling example needs the ollama client; skip when it is not
+# installed.
+try:
+    import ollama  # noqa: F401
+    deps_available = True
+except ImportError:
+    deps_available = False
+
+if deps_available:
+    import importlib
+
+    os.environ["TRACE_ENABLED"] = "1"
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    "..", "..", "agent_behavior_cloning"))
+    import llm_with_function_calling as fc
+    if not fc.TRACE_ENABLED:  # already imported untraced by another test
+        fc = importlib.reload(fc)
+
+    from opto.trace.bundle import FunModule
+    from opto.trace.modules import Module
+    from opto.trace.nodes import MessageNode
+
+    # @trace.model applied: agents are Modules that expose parameters.
+    assert issubclass(fc.LLMAgent, Module)
+
+    # The inline bundle(trainable=True)(...) application must leave a
+    # FunModule whose stored source is valid Python; a decorator line left in
+    # the parameter would make the re-exec'ed code a SyntaxError on the first
+    # traced call.
+    fun_module = next(c.__dict__["process_query"] for c in fc.LLMAgent.__mro__
+                      if "process_query" in c.__dict__)
+    assert isinstance(fun_module, FunModule)
+    assert fun_module.trainable
+    compile(fun_module.parameter.data, "<trainable process_query>", "exec")
+
+    # Exercise the traced call itself: a trainable FunModule re-execs its
+    # stored source on every invocation, so this catches anything the compile
+    # check above misses (e.g. names missing from the captured locals). The
+    # client is faked so no ollama server is needed.
+    class FakeAsyncClient:
+        def __init__(self, **kwargs):
+            pass
+
+        async def chat(self, **kwargs):
+            return {"message": {"role": "assistant",
+                                "content": "traced hello",
+                                "tool_calls": None}}
+
+        async def embeddings(self, **kwargs):
+            return {"embedding": [0.0] * fc.EMBED_DIM}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fc.CACHE_PATH = os.path.join(tmpdir, "chat_cache.sqlite")
+        fc._cache_db = None
+        fc._mem_cache = {}
+        real_client = fc.ollama.AsyncClient
+        fc.ollama.AsyncClient = FakeAsyncClient
+        try:
+            agent = fc.LLMAgent(fc.MODEL)
+            answer = agent.process_query("Please greet me politely.")
+            assert isinstance(answer, MessageNode)
+            assert answer.data == "traced hello"
+        finally:
+            fc.ollama.AsyncClient = real_client
+
+    os.environ.pop("TRACE_ENABLED", None)
+    print("trace gating smoke check ok")